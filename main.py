@@ -1,9 +1,29 @@
 # Python imports
 import json
 import os
+import re
 import subprocess
+import sys
 from collections import namedtuple
-from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+try:
+    from functools import cached_property
+except ImportError:  # Python < 3.8
+    class cached_property:
+        """ Minimal stand-in for functools.cached_property: compute once, then store on the instance. """
+
+        def __init__(self, func):
+            self.func = func
+            self.__doc__ = func.__doc__
+
+        def __get__(self, instance, owner=None):
+            if instance is None:
+                return self
+
+            value = instance.__dict__[self.func.__name__] = self.func(instance)
+            return value
 
 # Pip imports
 import requests
@@ -11,9 +31,27 @@ import requests
 
 BASE_PR_COMMENT = "👔 Code pros! Mind taking a look at this PR?\ncc:{}"
 PR_COMMENT_TITLE = "<!-- codenotify report -->\n"
+PR_COMMENT_LABEL_PREFIX = "codenotify:"
 CODEPROS_FILE = "CODEPROS"
+SPECIALIZED_MATCHER_MAX_GLOBS = 16
+
+# the only parts of the GitHub event main() reads (None keeps a value whole, a list applies to every item),
+# everything else is dropped right after parsing
+GITHUB_EVENT_FIELDS = {
+    "pull_request": {
+        "base": {"sha": None},
+        "draft": None,
+        "head": {"sha": None},
+        "labels": [{"name": None}],
+        "node_id": None,
+        "number": None,
+        "user": {"login": None},
+    },
+    "repository": {"full_name": None},
+}
 
 # Env vars
+GITHUB_API_URL_ENV_VAR = "GITHUB_API_URL"
 GITHUB_EVENT_PATH_ENV_VAR = "GITHUB_EVENT_PATH"
 GITHUB_GRAPHQL_URL_ENV_VAR = "GITHUB_GRAPHQL_URL"
 GITHUB_TOKEN_ENV_VAR = "GITHUB_TOKEN"
@@ -22,16 +60,16 @@ GITHUB_WORKSPACE_ENV_VAR = "GITHUB_WORKSPACE"
 
 # GraphQL queries & mutations
 
-GRAPHQL_GET_PR_COMMENTS = """
-  query GetPullRequestComments ($nodeId: ID!) {
+GRAPHQL_GET_PR_BOOTSTRAP = """
+  query GetPullRequestBootstrap ($nodeId: ID!, $includeComments: Boolean!) {
     node(id: $nodeId) {
      ... on PullRequest {
-       comments(first: 100) {
+       commits {
+         totalCount
+       }
+       comments(first: 100) @include(if: $includeComments) {
          nodes {
            id
-           author {
-             login
-           }
            body
          }
        }
@@ -40,18 +78,6 @@ GRAPHQL_GET_PR_COMMENTS = """
   }
 """
 
-GRAPHQL_GET_PR_COMMIT_COUNT = """
-  query CommitCount ($nodeId: ID!) {
-    node(id: $nodeId) {
-      ... on PullRequest {
-        commits {
-          totalCount
-        }
-      }
-    }
-  }
-"""
-
 
 GRAPHQL_ADD_PR_COMMENT = """
   mutation AddComment ($subjectId: ID!, $body: String!) {
@@ -59,7 +85,11 @@ GRAPHQL_ADD_PR_COMMENT = """
       subjectId: $subjectId
       body: $body
     }) {
-      clientMutationId
+      commentEdge {
+        node {
+          id
+        }
+      }
     }
   }
 """
@@ -77,7 +107,15 @@ GRAPHQL_UPDATE_PR_COMMENT = """
 
 
 # simple obj matching patterns over path strings (glob) to code pros
-CodeProsGlob = namedtuple("CodeProsGlob", ("glob", "pros"))
+CodeProsGlob = namedtuple("CodeProsGlob", ("glob", "pros", "regex", "prefix"))
+
+GLOB_WILDCARDS = re.compile(r"[*?\[]")
+
+
+def dump_json(data):
+    """ Serialize data to compact JSON for a GitHub API request body. """
+
+    return json.dumps(data, separators=(",", ":"))
 
 
 def load_env_var(env_var):
@@ -90,85 +128,250 @@ def load_env_var(env_var):
     return val
 
 
+class GitHubAPIError(Exception):
+    """ GitHub GraphQL or REST API request failed or returned errors. """
+
+    def __init__(self, message, errors=(), status_code=None):
+        super().__init__(message)
+        self.errors = errors
+        self.status_code = status_code
+
+    @property
+    def is_not_found(self):
+        if self.status_code == requests.codes.not_found:
+            return True
+
+        return any(error.get("type") == "NOT_FOUND" for error in self.errors)
+
+
 class GitHubGraphQLClient:
     """ GitHub GraphQL client to access the GitHub GraphQL API."""
 
-    def __init__(self):
-        self._github_graphql_url = None
-        self._github_token = None
-
     def make_request(self, query, variables):
         """ Make a GraphQL query to the GitHub API and return the JSON result."""
 
         try:
-            body = json.dumps({"query": query, "variables": variables})
+            body = dump_json({"query": query, "variables": variables})
         except TypeError:
             raise TypeError("GitHub GraphQL query cannot be serialized from JSON.")
 
-        response = requests.post(self.github_graphql_url, headers=self.headers, data=body)
+        response = self.session.post(self.github_graphql_url, data=body)
         if response.status_code != requests.codes.ok:
-            raise Exception(f"GitHub GraphQL Non-200 Response: {response.text}")
+            raise GitHubAPIError(
+                f"GitHub GraphQL Non-200 Response: {response.text}", status_code=response.status_code)
 
-        return response.json()
+        response_data = response.json()
+        if response_data.get("errors"):
+            raise GitHubAPIError(
+                f"GitHub GraphQL Error Response: {response_data['errors']}", errors=response_data["errors"])
 
-    @property
-    def github_graphql_url(self):
-        if self._github_graphql_url is None:
-            self._github_graphql_url = load_env_var(GITHUB_GRAPHQL_URL_ENV_VAR)
+        return response_data
 
-        return self._github_graphql_url
+    def make_rest_request(self, method, path, payload=None):
+        """ Make a request to the GitHub REST API for the few operations GraphQL can't do. """
 
-    @property
-    def github_token(self):
-        if self._github_token is None:
-            self._github_token = load_env_var(GITHUB_TOKEN_ENV_VAR)
+        response = self.session.request(
+            method,
+            f"{self.github_api_url}{path}",
+            data=dump_json(payload) if payload is not None else None)
+        if not response.ok:
+            raise GitHubAPIError(f"GitHub REST Non-2xx Response: {response.text}", status_code=response.status_code)
 
-        return self._github_token
+    @cached_property
+    def github_api_url(self):
+        return load_env_var(GITHUB_API_URL_ENV_VAR)
 
-    @property
+    @cached_property
+    def github_graphql_url(self):
+        return load_env_var(GITHUB_GRAPHQL_URL_ENV_VAR)
+
+    @cached_property
+    def github_token(self):
+        return load_env_var(GITHUB_TOKEN_ENV_VAR)
+
+    @cached_property
     def headers(self):
         return {"Authorization": f"bearer {self.github_token}"}
 
+    @cached_property
+    def session(self):
+        # reuse one keep-alive connection so only the first request pays for the TLS handshake
+        session = requests.Session()
+        session.headers.update(self.headers)
+
+        return session
+
 
 github_graphql_client = GitHubGraphQLClient()
 
 
-def get_changed_files(github_dir, pr_id, base_ref, head_ref):
-    """ Get a collection of files changed in this branch. """
+def get_pull_request_data(pr_id, include_comments=True):
+    """ Get the commit count and (optionally) existing comments of a PR in a single GraphQL request. """
+
+    response = github_graphql_client.make_request(
+        GRAPHQL_GET_PR_BOOTSTRAP,
+        {"nodeId": pr_id, "includeComments": include_comments})
+    return response["data"]["node"]
+
+
+def has_merge_base(github_dir, base_ref, head_ref):
+    """ Check whether the checkout already has the history needed to diff base and head. """
+
+    merge_base = subprocess.run(
+        ["git", "-C", github_dir, "merge-base", base_ref, head_ref],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+
+    return merge_base.returncode == 0
+
 
-    response = github_graphql_client.make_request(GRAPHQL_GET_PR_COMMIT_COUNT, {"nodeId": pr_id})
-    commit_count = response["data"]["node"]["commits"]["totalCount"]
+def get_checkout_commit(github_dir):
+    """ Get the commit checked out in the workspace, or None if it isn't a git checkout. """
 
-    # fetch all latest commits
-    _ = subprocess.run(["git", "-C", github_dir, "-c", "protocol.version=2", "fetch", "--deepen", str(commit_count)])
+    rev_parse = subprocess.run(
+        ["git", "-C", github_dir, "rev-parse", "HEAD"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True)
 
-    output = subprocess.getoutput(
-            f"git -C {github_dir} diff --name-only {base_ref}...{head_ref}")
+    return rev_parse.stdout.strip() if rev_parse.returncode == 0 else None
 
-    return [changed_file for changed_file in output.split("\n") if changed_file]
+
+def get_changed_files(github_dir, base_ref, head_ref, get_commit_count):
+    """ Get a collection of files changed in this branch, get_commit_count is only called when fetching. """
+
+    # fetch all latest commits, unless the checkout has them already (e.g. actions/checkout with fetch-depth: 0)
+    if not has_merge_base(github_dir, base_ref, head_ref):
+        commit_count = get_commit_count()
+        _ = subprocess.run(
+            ["git", "-C", github_dir, "-c", "protocol.version=2", "fetch", "--deepen", str(commit_count)])
+
+    # run git directly rather than through a shell, the refs and directory are never parsed as shell syntax
+    # deleted files are skipped (there is nothing left to notify about) and names are NUL separated, so
+    # file names containing newlines or non-ASCII characters come back untouched
+    diff = subprocess.run(
+        ["git", "--no-pager", "-C", github_dir,
+         "diff", "-z", "--diff-filter=d", "--name-only", f"{base_ref}...{head_ref}"],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True)
+
+    return [changed_file for changed_file in diff.stdout.split("\0") if changed_file]
 
 
 def globulize_filepath(filepath):
     """ Take a filepath defined and if a specific file is not specified, make it greedy in glob format. """
 
     # remove leading slash
-    if filepath[0] == "/":
+    if filepath.startswith("/"):
         filepath = filepath[1:]
 
     # is targeting a file specifically, no change needed
     if "." in filepath.split("/")[-1]:
         return filepath
 
-    # /src/ --> /src/*
-    if filepath[-1] == "/":
-        filepath += "*"
-    # /src --> /src/*
-    elif filepath[-1] != "*":
-        filepath += "/*"
+    # /src/ --> /src/**
+    if filepath.endswith("/"):
+        filepath += "**"
+    # /src --> /src/**
+    elif not filepath.endswith("*"):
+        filepath += "/**"
 
     return filepath
 
 
+def translate_glob(glob):
+    """ Translate a CODEPROS glob to a regex, * and ? stay within a directory while ** spans directories. """
+
+    index, length = 0, len(glob)
+    regex_parts = []
+
+    while index < length:
+        char = glob[index]
+        at_segment_start = index == 0 or glob[index - 1] == "/"
+
+        if glob.startswith("**/", index) and at_segment_start:  # zero or more directories
+            regex_parts.append("(?:.*/)?")
+            index += 3
+            continue
+
+        if glob.startswith("**", index) and at_segment_start and index + 2 == length:  # everything below
+            regex_parts.append(".*")
+            index += 2
+            continue
+
+        if char == "*":
+            regex_parts.append("[^/]*")
+            while index + 1 < length and glob[index + 1] == "*":  # a**b is the same as a*b
+                index += 1
+        elif char == "?":
+            regex_parts.append("[^/]")
+        elif char == "[":
+            # like fnmatch, a "]" right after "[" or "[!" is part of the set
+            end = index + 1
+            if end < length and glob[end] == "!":
+                end += 1
+            if end < length and glob[end] == "]":
+                end += 1
+            end = glob.find("]", end)
+
+            if end == -1:  # no closing bracket, match it literally
+                regex_parts.append(re.escape(char))
+            else:
+                char_set = re.sub(r"([\\&~|\[])", r"\\\1", glob[index + 1:end])
+                if char_set.startswith("!"):
+                    char_set = "^/" + char_set[1:]
+                elif char_set.startswith("^"):
+                    char_set = "\\" + char_set
+                regex_parts.append(f"[{char_set}]")
+                index = end
+        else:
+            regex_parts.append(re.escape(char))
+
+        index += 1
+
+    return f"(?s:{''.join(regex_parts)})\\Z"
+
+
+def get_glob_prefix(glob):
+    """ Get the literal first path segment every match of a glob starts with, or "" if it has a wildcard. """
+
+    literal = GLOB_WILDCARDS.split(glob, 1)[0]
+
+    # src/*.py --> src, main.py --> main.py, *.py --> ""
+    if "/" in literal:
+        return literal.split("/", 1)[0]
+    if literal == glob:
+        return glob
+
+    return ""
+
+
+def get_glob_directory(glob):
+    """ Get the literal directory every match of a glob lives under, or "" if it could be anywhere. """
+
+    literal = GLOB_WILDCARDS.split(glob, 1)[0]
+
+    # src/api/*.py --> src/api, src/main.py --> src, *.py --> ""
+    return literal.rsplit("/", 1)[0] if "/" in literal else ""
+
+
+def get_path_prefix(path):
+    """ Get the first path segment of a changed file, to look up the globs that can match it. """
+
+    return path.split("/", 1)[0]
+
+
+def make_code_pros_glob(glob, pros):
+    """ Build a CodeProsGlob, precompiling its regex and literal prefix. """
+
+    return CodeProsGlob(
+        glob=glob,
+        pros=frozenset(pros),
+        regex=re.compile(translate_glob(glob)),
+        prefix=get_glob_prefix(glob))
+
+
 def get_code_pros_globs(codepros_location, ignore_pros):
     """ Build a collection of CodeProsGlob objects from the CODEPROS file ignoring any pros. """
 
@@ -178,60 +381,238 @@ def get_code_pros_globs(codepros_location, ignore_pros):
 
     code_pro_globs = []
     with open(codepros_location) as codepros_file:
-        for line in codepros_file:
-            if line[0] == "#":  # commented out line
-                continue
-
-            pro_pattern_line = line[:-1].split(" ")
+        # drop empty and commented out lines in one pass, only rule lines are left to validate
+        rule_lines = [line for line in codepros_file.read().splitlines() if line and not line.startswith("#")]
 
-            if not pro_pattern_line[0]:
-                if len(pro_pattern_line) == 1:  # empty line
-                    continue
+    for line in rule_lines:
+        pro_pattern_line = line.split()
 
-                raise IOError(f"CODEPROS file malformed, line missing file: \"{line}\"")
+        if not pro_pattern_line:  # whitespace only line
+            continue
 
-            filepath = pro_pattern_line[0]
-            pros = set(pro_pattern_line[1:])
+        # a rule line must begin with its file pattern, e.g. " @pro" is missing it
+        if line[0].isspace():
+            raise IOError(f"CODEPROS file malformed, line missing file: \"{line}\"")
 
-            pros -= ignore_pros
-            if not pros:
-                continue
+        filepath = pro_pattern_line[0]
+        # the same handles repeat across rules, interning them makes comparing and hashing them cheap
+        pros = frozenset(sys.intern(pro) for pro in pro_pattern_line[1:]) - ignore_pros
+        if not pros:
+            continue
 
-            glob = globulize_filepath(filepath)
+        glob = globulize_filepath(filepath)
 
-            for pro in pros:
-                if pro[0] != "@" or len(pro) < 2:
-                    raise IOError(f"CODEPROS file malformed, pro incorrect: \"{line}\"")
+        for pro in pros:
+            if not pro.startswith("@") or len(pro) < 2:
+                raise IOError(f"CODEPROS file malformed, pro incorrect: \"{line}\"")
 
-            code_pro_globs.append(CodeProsGlob(pros=pros, glob=glob))
+        code_pro_globs.append(make_code_pros_glob(glob, pros))
 
     return code_pro_globs
 
 
-def comment_on_pr(pr_id, pros):
-    """ Add (or change) a comment on a PR to notify code pros by their GitHub handle. """
+def prune_missing_code_pros_globs(github_dir, code_pro_globs, is_head_checkout):
+    """ Drop CodeProsGlob objects whose directory is missing from the checkout, they can't match a changed file. """
 
-    response = github_graphql_client.make_request(GRAPHQL_GET_PR_COMMENTS, {"nodeId": pr_id})
+    directory_exists = {}
+    existing_code_pro_globs = []
+    missing_code_pro_globs = []
+    for code_pro_glob in code_pro_globs:
+        directory = get_glob_directory(code_pro_glob.glob)
+        if directory not in directory_exists:
+            directory_exists[directory] = not directory or os.path.isdir(os.path.join(github_dir, directory))
 
-    comment_id = None
-    for comment in response["data"]["node"]["comments"]["nodes"]:
-        if comment["body"].startswith(PR_COMMENT_TITLE):
-            comment_id = comment["id"]
+        if directory_exists[directory]:
+            existing_code_pro_globs.append(code_pro_glob)
+        else:
+            missing_code_pro_globs.append(code_pro_glob)
+
+    # only safe on a checkout of the PR's head: deleted files are never diffed, so every changed file exists there
+    # is_head_checkout spawns git, so it is only called when there's a rule to prune
+    if not missing_code_pro_globs or not is_head_checkout():
+        return code_pro_globs
+
+    for code_pro_glob in missing_code_pro_globs:
+        print(f"Skipping rule {code_pro_glob.glob}, {get_glob_directory(code_pro_glob.glob)} does not exist")
+
+    return existing_code_pro_globs
+
+
+def build_regex_matcher(code_pro_globs):
+    """ Build a function returning every CodeProsGlob matching a path, using a single combined regex scan. """
+
+    # each glob sits in its own optional lookahead, so one match reports every matching glob, not just the first
+    named_globs = [(f"codepros{index}", code_pro_glob) for index, code_pro_glob in enumerate(code_pro_globs)]
+    combined_regex = re.compile("".join(
+        f"(?:(?=(?P<{name}>{code_pro_glob.regex.pattern})))?" for name, code_pro_glob in named_globs))
+
+    def match_code_pros_globs(changed_file):
+        matched_groups = combined_regex.match(changed_file).groupdict()
+        return [code_pro_glob for name, code_pro_glob in named_globs if matched_groups[name] is not None]
+
+    return match_code_pros_globs
+
+
+def build_specialized_matcher(code_pro_globs):
+    """ Build a function returning every CodeProsGlob matching a path, generated as a flat series of checks. """
+
+    # each regex match and glob is bound as a default argument, so the generated checks only touch locals
+    namespace = {}
+    arguments = []
+    checks = []
+    for index, code_pro_glob in enumerate(code_pro_globs):
+        namespace[f"_match{index}"] = code_pro_glob.regex.match
+        namespace[f"_glob{index}"] = code_pro_glob
+        arguments.append(f"_match{index}=_match{index}, _glob{index}=_glob{index}")
+        checks.append(f"    if _match{index}(changed_file):\n        matched.append(_glob{index})\n")
+
+    source = (
+        f"def match_code_pros_globs(changed_file, {', '.join(arguments)}):\n"
+        "    matched = []\n"
+        f"{''.join(checks)}"
+        "    return matched\n")
+    exec(source, namespace)
+
+    return namespace["match_code_pros_globs"]
+
+
+def build_code_pros_matcher(code_pro_globs):
+    """ Build a function returning every CodeProsGlob matching a path, only scanning globs its prefix allows. """
+
+    # globs starting with a wildcard can match any path, so every bucket carries them too
+    unprefixed_globs = []
+    prefix_to_globs = {}
+    for code_pro_glob in code_pro_globs:
+        if code_pro_glob.prefix:
+            prefix_to_globs.setdefault(code_pro_glob.prefix, list(unprefixed_globs)).append(code_pro_glob)
+        else:
+            unprefixed_globs.append(code_pro_glob)
+            for prefixed_globs in prefix_to_globs.values():
+                prefixed_globs.append(code_pro_glob)
+
+    # a handful of globs is cheaper to check one after another than through the combined regex
+    def build_matcher(globs):
+        if len(globs) <= SPECIALIZED_MATCHER_MAX_GLOBS:
+            return build_specialized_matcher(globs)
+
+        return build_regex_matcher(globs)
+
+    unprefixed_matcher = build_matcher(unprefixed_globs)
+    prefix_to_matcher = {prefix: build_matcher(globs) for prefix, globs in prefix_to_globs.items()}
+
+    def match_code_pros_globs(changed_file):
+        return prefix_to_matcher.get(get_path_prefix(changed_file), unprefixed_matcher)(changed_file)
+
+    return match_code_pros_globs
+
+
+def get_code_pros(changed_files, code_pro_globs):
+    """ Collect the pros of every CodeProsGlob matching any of the changed files. """
+
+    all_pros = set().union(*(code_pro_glob.pros for code_pro_glob in code_pro_globs))
+    match_code_pros_globs = build_code_pros_matcher(code_pro_globs)
+
+    pros = set()
+    for changed_file in changed_files:
+        # rules whose pros are all notified already can't add anything, skip them
+        new_code_pro_globs = [
+            code_pro_glob for code_pro_glob in match_code_pros_globs(changed_file)
+            if not code_pro_glob.pros <= pros]
+        for code_pro_glob in new_code_pro_globs:
+            print(f"Rule {code_pro_glob.glob} matches {changed_file}")
+
+        pros.update(*(code_pro_glob.pros for code_pro_glob in new_code_pro_globs))
+
+        if pros >= all_pros:  # nobody left to notify
             break
 
+    return pros
+
+
+def get_labeled_comment_id(labels):
+    """ Get the id of codenotify's comment remembered in a PR label, if one was added. """
+
+    comment_ids = [
+        label["name"][len(PR_COMMENT_LABEL_PREFIX):] for label in labels
+        if label["name"].startswith(PR_COMMENT_LABEL_PREFIX)]
+
+    # a stale label that failed to delete can't be told apart from the current one, search the comments instead
+    return comment_ids[0] if len(comment_ids) == 1 else None
+
+
+def find_pr_comment_id(existing_comments):
+    """ Find the id of codenotify's comment among the existing comments on a PR. """
+
+    # match on the title alone, the comment may have been posted with a different token (e.g. before a PAT)
+    for comment in existing_comments:
+        if comment["body"].startswith(PR_COMMENT_TITLE):
+            return comment["id"]
+
+    return None
+
+
+def label_pr_comment(repository, pr_number, comment_id, stale_comment_id=None):
+    """ Remember the id of codenotify's comment in a PR label, so later runs don't have to search for it. """
+
+    # the comment is already posted, a missing label only costs searching the comments next run
+    try:
+        github_graphql_client.make_rest_request(
+            "POST",
+            f"/repos/{repository}/issues/{pr_number}/labels",
+            {"labels": [f"{PR_COMMENT_LABEL_PREFIX}{comment_id}"]})
+    except (EnvironmentError, GitHubAPIError) as ex:
+        print(f"Unable to label comment: {ex}")
+
+    if not stale_comment_id:
+        return
+
+    # labels are created repository wide, delete the stale one outright rather than only detaching it
+    try:
+        stale_label = quote(f"{PR_COMMENT_LABEL_PREFIX}{stale_comment_id}", safe="")
+        github_graphql_client.make_rest_request("DELETE", f"/repos/{repository}/labels/{stale_label}")
+    except GitHubAPIError as ex:
+        if not ex.is_not_found:  # already deleted
+            print(f"Unable to delete stale label: {ex}")
+
+
+def comment_on_pr(pr_id, pros, comment_id=None):
+    """ Add (or change) a comment on a PR to notify code pros by their GitHub handle, returning its id. """
+
     comment = BASE_PR_COMMENT.format(" ".join(pros))
     comment = f"{PR_COMMENT_TITLE}\n{comment}"
 
     if comment_id:  # update existing comment
         print(f"Updating comment pros to include {pros}")
-        _ = github_graphql_client.make_request(
-            GRAPHQL_UPDATE_PR_COMMENT,
-            {"id": comment_id, "body": comment})
-    else:  # add new comment
-        print(f"Adding new comment with pros {pros}")
-        _ = github_graphql_client.make_request(
-            GRAPHQL_ADD_PR_COMMENT,
-            {"subjectId": pr_id, "body": comment})
+        try:
+            _ = github_graphql_client.make_request(
+                GRAPHQL_UPDATE_PR_COMMENT,
+                {"id": comment_id, "body": comment})
+            return comment_id
+        except GitHubAPIError as ex:
+            if not ex.is_not_found:  # only a deleted comment is replaced, anything else could duplicate it
+                raise
+
+            print(f"Comment {comment_id} no longer exists, adding a new one")
+
+    # add new comment
+    print(f"Adding new comment with pros {pros}")
+    response = github_graphql_client.make_request(
+        GRAPHQL_ADD_PR_COMMENT,
+        {"subjectId": pr_id, "body": comment})
+
+    return response["data"]["addComment"]["commentEdge"]["node"]["id"]
+
+
+def select_json_fields(data, fields):
+    """ Copy only the fields of decoded JSON data described by fields, see GITHUB_EVENT_FIELDS. """
+
+    if fields is None:
+        return data
+
+    if isinstance(fields, list):
+        return [select_json_fields(item, fields[0]) for item in data]
+
+    return {key: select_json_fields(data[key], key_fields) for key, key_fields in fields.items() if key in data}
 
 
 def get_github_event_data(path):
@@ -246,7 +627,7 @@ def get_github_event_data(path):
     if "pull_request" not in github_event_data:
         raise ValueError("GitHub event file is missing pull request data, is it configured correctly?")
 
-    return github_event_data
+    return select_json_fields(github_event_data, GITHUB_EVENT_FIELDS)
 
 
 def main():
@@ -269,19 +650,47 @@ def main():
 
     # do not notify this pr's author
     code_pro_globs = get_code_pros_globs(codepros_location, ignore_pros={pr_author})
+    # other checkouts (e.g. the base ref with pull_request_target) lack the directories this PR adds
+    code_pro_globs = prune_missing_code_pros_globs(
+        github_dir, code_pro_globs, lambda: get_checkout_commit(github_dir) == head_ref)
     if not code_pro_globs:
         print("No CODEPROS globs found.")
         return
 
-    pros = set()
-    for changed_file in get_changed_files(github_dir, pr_id, base_ref, head_ref):
-        for code_pro_glob in code_pro_globs:
-            if fnmatch(changed_file, code_pro_glob.glob):
-                print(f"Rule {code_pro_glob.glob} matches {changed_file}")
-                pros |= code_pro_glob.pros
+    # comments only need searching when no label remembers which one is codenotify's
+    labeled_comment_id = get_labeled_comment_id(github_event_data["pull_request"].get("labels", []))
+
+    if labeled_comment_id:
+        # only the commit count is left to query, and only when the clone has to be deepened
+        def get_commit_count():
+            return get_pull_request_data(pr_id, include_comments=False)["commits"]["totalCount"]
+
+        changed_files = get_changed_files(github_dir, base_ref, head_ref, get_commit_count)
+        pros = get_code_pros(changed_files, code_pro_globs)
+    else:
+        # the GraphQL request is network bound, keep working on the changed files while it is in flight and
+        # only wait for it once the commit count (or the comments) are actually needed
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pull_request_future = executor.submit(get_pull_request_data, pr_id, include_comments=True)
+
+            def get_commit_count():
+                return pull_request_future.result()["commits"]["totalCount"]
+
+            changed_files = get_changed_files(github_dir, base_ref, head_ref, get_commit_count)
+            pros = get_code_pros(changed_files, code_pro_globs)
+
+            pull_request_data = pull_request_future.result()
 
     if pros:
-        comment_on_pr(pr_id, pros)
+        comment_id = labeled_comment_id or find_pr_comment_id(pull_request_data["comments"]["nodes"])
+        comment_id = comment_on_pr(pr_id, pros, comment_id)
+
+        if comment_id != labeled_comment_id:
+            label_pr_comment(
+                github_event_data["repository"]["full_name"],
+                github_event_data["pull_request"]["number"],
+                comment_id,
+                stale_comment_id=labeled_comment_id)
     else:
         print("No pros found for these files")
 
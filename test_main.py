@@ -1,5 +1,9 @@
 # Python imports
+import json
 import os
+import re
+import subprocess
+import tempfile
 import unittest
 from copy import deepcopy
 from unittest.mock import MagicMock, mock_open, patch
@@ -7,54 +11,98 @@ from unittest.mock import MagicMock, mock_open, patch
 # Internal imports
 from main import (
     CODEPROS_FILE,
+    GITHUB_API_URL_ENV_VAR,
     GITHUB_EVENT_PATH_ENV_VAR,
     GITHUB_GRAPHQL_URL_ENV_VAR,
     GITHUB_TOKEN_ENV_VAR,
     GITHUB_WORKSPACE_ENV_VAR,
     GRAPHQL_ADD_PR_COMMENT,
+    GRAPHQL_GET_PR_BOOTSTRAP,
     GRAPHQL_UPDATE_PR_COMMENT,
+    PR_COMMENT_LABEL_PREFIX,
     PR_COMMENT_TITLE,
-    CodeProsGlob,
     GitHubGraphQLClient,
+    GitHubAPIError,
+    build_code_pros_matcher,
+    build_regex_matcher,
+    build_specialized_matcher,
     comment_on_pr,
+    find_pr_comment_id,
     get_changed_files,
+    get_checkout_commit,
+    get_code_pros,
     get_code_pros_globs,
+    get_glob_directory,
+    get_glob_prefix,
     get_github_event_data,
+    get_labeled_comment_id,
+    get_pull_request_data,
     globulize_filepath,
+    label_pr_comment,
+    make_code_pros_glob,
+    prune_missing_code_pros_globs,
+    translate_glob,
     main,
 )
 
 
 class TestGetChangedFiles(unittest.TestCase):
 
-    @patch("subprocess.getoutput", return_value="")
-    @patch("subprocess.run", return_value="")
-    @patch(
-        "main.github_graphql_client.make_request",
-        return_value={"data": {"node": {"commits": {"totalCount": 1}}}})
-    def test_no_files_returned(self, github_graphql, run, get_output):
-        files = get_changed_files("/",
-                                  "abc123",
-                                  "ffc33a2baaebb4aa1e8ab035f89050b186a2ad36",
-                                  "d51184732797cbf1e3fc39b618e6f1688cc34a03")
+    BASE_REF = "ffc33a2baaebb4aa1e8ab035f89050b186a2ad36"
+    HEAD_REF = "d51184732797cbf1e3fc39b618e6f1688cc34a03"
 
-        get_output.assert_called()
+    @patch("subprocess.run", return_value=subprocess.CompletedProcess([], 0, stdout=""))
+    def test_no_files_returned(self, run):
+        files = get_changed_files("/", self.BASE_REF, self.HEAD_REF, lambda: 1)
+
+        self.assertEqual(run.call_args[0][0],
+                         ["git", "--no-pager", "-C", "/", "diff", "-z", "--diff-filter=d", "--name-only",
+                          f"{self.BASE_REF}...{self.HEAD_REF}"])
         self.assertEqual(files, [])
 
-    @patch("subprocess.getoutput", return_value="main.py\ntest_main.py")
-    @patch("subprocess.run", return_value="")
-    @patch(
-        "main.github_graphql_client.make_request",
-        return_value={"data": {"node": {"commits": {"totalCount": 1}}}})
-    def test_multiple_files_returned(self, github_graphql, run, get_output):
-        files = get_changed_files("/",
-                                  "abc123",
-                                  "ffc33a2baaebb4aa1e8ab035f89050b186a2ad36",
-                                  "d51184732797cbf1e3fc39b618e6f1688cc34a03")
+    @patch("subprocess.run", return_value=subprocess.CompletedProcess([], 0, stdout="main.py\0test_main.py\0"))
+    def test_multiple_files_returned(self, run):
+        files = get_changed_files("/", self.BASE_REF, self.HEAD_REF, lambda: 1)
 
-        get_output.assert_called()
+        self.assertEqual(run.call_count, 2)
         self.assertEqual(files, ["main.py", "test_main.py"])
 
+    @patch("subprocess.run", return_value=subprocess.CompletedProcess([], 0, stdout=""))
+    def test_history_present_skips_fetch(self, run):
+        get_commit_count = MagicMock(return_value=1)
+        _ = get_changed_files("/", self.BASE_REF, self.HEAD_REF, get_commit_count)
+
+        self.assertEqual(run.call_args_list[0][0][0], ["git", "-C", "/", "merge-base", self.BASE_REF, self.HEAD_REF])
+        self.assertFalse(any("fetch" in call[0][0] for call in run.call_args_list))
+        get_commit_count.assert_not_called()
+
+    @patch("subprocess.run", side_effect=[
+        subprocess.CompletedProcess([], 1),
+        subprocess.CompletedProcess([], 0),
+        subprocess.CompletedProcess([], 0, stdout="main.py\0")])
+    def test_history_missing_fetches(self, run):
+        files = get_changed_files("/", self.BASE_REF, self.HEAD_REF, lambda: 3)
+
+        self.assertEqual(run.call_args_list[1][0][0],
+                         ["git", "-C", "/", "-c", "protocol.version=2", "fetch", "--deepen", "3"])
+        self.assertEqual(files, ["main.py"])
+
+    @patch("subprocess.run", return_value=subprocess.CompletedProcess([], 0, stdout="new\nline.py\0main.py\0"))
+    def test_file_name_with_newline(self, run):
+        files = get_changed_files("/", self.BASE_REF, self.HEAD_REF, lambda: 1)
+        self.assertEqual(files, ["new\nline.py", "main.py"])
+
+
+class TestGetCheckoutCommit(unittest.TestCase):
+
+    @patch("subprocess.run", return_value=subprocess.CompletedProcess([], 0, stdout="8ef970e\n"))
+    def test_checkout_commit(self, run):
+        self.assertEqual(get_checkout_commit("/"), "8ef970e")
+
+    @patch("subprocess.run", return_value=subprocess.CompletedProcess([], 128, stdout=""))
+    def test_not_a_checkout(self, run):
+        self.assertIsNone(get_checkout_commit("/"))
+
 
 class TestGlobulizeFilepath(unittest.TestCase):
 
@@ -64,10 +112,108 @@ class TestGlobulizeFilepath(unittest.TestCase):
 
     def test_directories(self):
         glob_filepath = globulize_filepath("hello/world/")
-        self.assertEqual(glob_filepath, "hello/world/*")
+        self.assertEqual(glob_filepath, "hello/world/**")
 
         glob_filepath = globulize_filepath("hello/world")
-        self.assertEqual(glob_filepath, "hello/world/*")
+        self.assertEqual(glob_filepath, "hello/world/**")
+
+    def test_explicit_glob(self):
+        glob_filepath = globulize_filepath("hello/*")
+        self.assertEqual(glob_filepath, "hello/*")
+
+
+class TestTranslateGlob(unittest.TestCase):
+
+    def assert_glob_matches(self, glob, matching_paths, other_paths):
+        regex = re.compile(translate_glob(glob))
+        for path in matching_paths:
+            self.assertTrue(regex.match(path), f"{glob} should match {path}")
+        for path in other_paths:
+            self.assertFalse(regex.match(path), f"{glob} should not match {path}")
+
+    def test_wildcard_within_directory(self):
+        self.assert_glob_matches("*", ["main.py"], ["src/main.py"])
+        self.assert_glob_matches("src/*.py", ["src/main.py"], ["src/api/main.py", "src/main.pyc"])
+        self.assert_glob_matches("ma?n.py", ["main.py"], ["ma/n.py"])
+
+    def test_globstar(self):
+        self.assert_glob_matches("**/readme.md", ["readme.md", "a/b/readme.md"], ["a/old_readme.md"])
+        self.assert_glob_matches("dir/**", ["dir/a", "dir/a/b"], ["dirs/a"])
+        self.assert_glob_matches("**/doc/**", ["doc/a", "a/doc/b/c"], ["adoc/b"])
+        self.assert_glob_matches("**/*", ["main.py", "a/b/main.py"], [])
+
+    def test_character_sets(self):
+        self.assert_glob_matches("[mt]ain.py", ["main.py", "tain.py"], ["rain.py"])
+        self.assert_glob_matches("[!m]ain.py", ["rain.py"], ["main.py", "/ain.py"])
+        self.assert_glob_matches("[main.py", ["[main.py"], ["main.py"])
+
+    def test_literal_characters(self):
+        self.assert_glob_matches("a+b.py", ["a+b.py"], ["aab.py", "a+bxpy"])
+
+
+class TestGetGlobPrefix(unittest.TestCase):
+
+    def test_directory_prefix(self):
+        self.assertEqual(get_glob_prefix("src/*"), "src")
+        self.assertEqual(get_glob_prefix("src/api/*.py"), "src")
+
+    def test_top_level_file(self):
+        self.assertEqual(get_glob_prefix("main.py"), "main.py")
+
+    def test_wildcard_prefix(self):
+        self.assertEqual(get_glob_prefix("*"), "")
+        self.assertEqual(get_glob_prefix("*.py"), "")
+        self.assertEqual(get_glob_prefix("s?c/*"), "")
+        self.assertEqual(get_glob_prefix("[sS]rc/*"), "")
+
+
+class TestPruneMissingCodeProsGlobs(unittest.TestCase):
+
+    def test_glob_directory(self):
+        self.assertEqual(get_glob_directory("src/api/*.py"), "src/api")
+        self.assertEqual(get_glob_directory("src/main.py"), "src")
+        self.assertEqual(get_glob_directory("src/**"), "src")
+        self.assertEqual(get_glob_directory("main.py"), "")
+        self.assertEqual(get_glob_directory("**/*.py"), "")
+
+    def test_missing_directories_pruned(self):
+        github_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(github_dir, "src"))
+
+        code_pro_globs = [
+            make_code_pros_glob("src/*", {"@pro"}),
+            make_code_pros_glob("docs/*", {"@pro2"}),
+            make_code_pros_glob("**/*.py", {"@pro3"}),
+            make_code_pros_glob("main.py", {"@pro4"}),
+        ]
+
+        try:
+            existing_code_pro_globs = prune_missing_code_pros_globs(github_dir, code_pro_globs, lambda: True)
+        finally:
+            os.rmdir(os.path.join(github_dir, "src"))
+            os.rmdir(github_dir)
+
+        self.assertEqual(existing_code_pro_globs, [code_pro_globs[0], code_pro_globs[2], code_pro_globs[3]])
+
+    @patch("os.path.isdir", return_value=True)
+    def test_directory_checked_once(self, isdir):
+        code_pro_globs = [make_code_pros_glob("src/*.py", {"@pro"}), make_code_pros_glob("src/*.md", {"@pro2"})]
+        _ = prune_missing_code_pros_globs("/", code_pro_globs, lambda: True)
+
+        isdir.assert_called_once_with("/src")
+
+    @patch("os.path.isdir", return_value=True)
+    def test_head_checkout_only_checked_to_prune(self, isdir):
+        is_head_checkout = MagicMock(return_value=True)
+        code_pro_globs = [make_code_pros_glob("src/*", {"@pro"}), make_code_pros_glob("*.py", {"@pro2"})]
+
+        self.assertEqual(prune_missing_code_pros_globs("/", code_pro_globs, is_head_checkout), code_pro_globs)
+        is_head_checkout.assert_not_called()
+
+    @patch("os.path.isdir", return_value=False)
+    def test_other_checkout_not_pruned(self, isdir):
+        code_pro_globs = [make_code_pros_glob("src/*", {"@pro"})]
+        self.assertEqual(prune_missing_code_pros_globs("/", code_pro_globs, lambda: False), code_pro_globs)
 
 
 class TestCodeProsGlobs(unittest.TestCase):
@@ -129,6 +275,34 @@ class TestCodeProsGlobs(unittest.TestCase):
         self.assertEqual(code_pros_globs[0].glob, "main.py")
         self.assertEqual(code_pros_globs[1].pros, {"@pro"})
         self.assertEqual(code_pros_globs[1].glob, "test_main.py")
+        self.assertIsInstance(code_pros_globs[0].pros, frozenset)
+
+    def test_comments_and_empty_lines_skipped(self):
+        codepros = "# @nobody\n\nmain.py @pro\n#main.py @pro2\n"
+        with patch("builtins.open", new_callable=mock_open, read_data=codepros) as m:
+            code_pros_globs = get_code_pros_globs(CODEPROS_FILE, set())
+
+        self.assertEqual(len(code_pros_globs), 1)
+        self.assertEqual(code_pros_globs[0].pros, {"@pro"})
+
+    def test_directory_rule_matches_nested_files(self):
+        with patch("builtins.open", new_callable=mock_open, read_data="backend @x\n") as m:
+            code_pros_globs = get_code_pros_globs(CODEPROS_FILE, set())
+
+        self.assertEqual(get_code_pros(["backend/api/v1/x.py"], code_pros_globs), {"@x"})
+        self.assertEqual(get_code_pros(["backend/x.py"], code_pros_globs), {"@x"})
+        self.assertEqual(get_code_pros(["backends/x.py"], code_pros_globs), set())
+
+    def test_whitespace_separated_codepros_file(self):
+        codepros = "main.py     @pro\t@pro2\n\n   \ntest_main.py @pro"
+        with patch("builtins.open", new_callable=mock_open, read_data=codepros) as m:
+            code_pros_globs = get_code_pros_globs(CODEPROS_FILE, set())
+
+        self.assertEqual(len(code_pros_globs), 2)
+        self.assertEqual(code_pros_globs[0].pros, {"@pro", "@pro2"})
+        self.assertEqual(code_pros_globs[0].glob, "main.py")
+        self.assertEqual(code_pros_globs[1].pros, {"@pro"})
+        self.assertEqual(code_pros_globs[1].glob, "test_main.py")
 
 
 class TestGitHubGraphQLClient(unittest.TestCase):
@@ -157,7 +331,7 @@ class TestGitHubGraphQLClient(unittest.TestCase):
             client = GitHubGraphQLClient()
             client.make_request("---", set())
 
-    @patch("requests.post", return_value=MagicMock(status_code=401))
+    @patch("requests.Session.post", return_value=MagicMock(status_code=401))
     def test_invalid_response(self, requests_post):
         os.environ[GITHUB_GRAPHQL_URL_ENV_VAR] = "invalid_response"
         os.environ[GITHUB_TOKEN_ENV_VAR] = "invalid_response"
@@ -173,8 +347,8 @@ class TestGitHubGraphQLClient(unittest.TestCase):
         os.environ[GITHUB_TOKEN_ENV_VAR] = "valid"
         client = GitHubGraphQLClient()
 
-        with patch("requests.post") as requests_post_patch:
-            response_mock = MagicMock(status_code=200)
+        with patch("requests.Session.post") as requests_post_patch:
+            response_mock = MagicMock(status_code=200, content=b'{"a": "ok"}')
             response_mock.json.return_value = {"a": "ok"}
 
             requests_post_patch.return_value = response_mock
@@ -182,20 +356,269 @@ class TestGitHubGraphQLClient(unittest.TestCase):
             response = client.make_request("---", {"a": "b"})
             self.assertEqual(response, {"a": "ok"})
 
+    def test_error_response(self):
+        os.environ[GITHUB_GRAPHQL_URL_ENV_VAR] = "valid"
+        os.environ[GITHUB_TOKEN_ENV_VAR] = "valid"
+        client = GitHubGraphQLClient()
 
-class TestCommentOnPR(unittest.TestCase):
+        with patch("requests.Session.post") as requests_post_patch:
+            response_mock = MagicMock(
+                status_code=200, content=b'{"data": null, "errors": [{"message": "not found"}]}')
+            response_mock.json.return_value = {"data": None, "errors": [{"message": "not found"}]}
+
+            requests_post_patch.return_value = response_mock
+
+            with self.assertRaises(GitHubAPIError) as ex:
+                client.make_request("---", {"a": "b"})
+
+        self.assertTrue(str(ex.exception).startswith("GitHub GraphQL Error Response"))
+
+    @patch("requests.Session.request", return_value=MagicMock(ok=False))
+    def test_invalid_rest_response(self, requests_request):
+        os.environ[GITHUB_API_URL_ENV_VAR] = "https://api.github.com"
+        os.environ[GITHUB_TOKEN_ENV_VAR] = "valid"
+        client = GitHubGraphQLClient()
+
+        with self.assertRaises(GitHubAPIError) as ex:
+            client.make_rest_request("POST", "/repos/a/b/issues/1/labels", {"labels": ["c"]})
+
+        self.assertTrue(str(ex.exception).startswith("GitHub REST Non-2xx Response"))
+        self.assertEqual(requests_request.call_args[0],
+                         ("POST", "https://api.github.com/repos/a/b/issues/1/labels"))
+
+    def test_compact_json_body(self):
+        os.environ[GITHUB_GRAPHQL_URL_ENV_VAR] = "valid"
+        os.environ[GITHUB_TOKEN_ENV_VAR] = "valid"
+        client = GitHubGraphQLClient()
+
+        with patch("requests.Session.post") as requests_post_patch:
+            response_mock = MagicMock(status_code=200)
+            response_mock.json.return_value = {"a": "ok"}
+
+            requests_post_patch.return_value = response_mock
+
+            response = client.make_request("---", {"a": "b"})
+
+        self.assertEqual(response, {"a": "ok"})
+        self.assertEqual(requests_post_patch.call_args[1]["data"], '{"query":"---","variables":{"a":"b"}}')
+
+    def test_session_reused(self):
+        os.environ[GITHUB_GRAPHQL_URL_ENV_VAR] = "valid"
+        os.environ[GITHUB_TOKEN_ENV_VAR] = "valid"
+        client = GitHubGraphQLClient()
+
+        self.assertIs(client.session, client.session)
+        self.assertEqual(client.session.headers["Authorization"], "bearer valid")
+
+    def test_env_vars_loaded_once(self):
+        os.environ[GITHUB_GRAPHQL_URL_ENV_VAR] = "valid"
+        os.environ[GITHUB_TOKEN_ENV_VAR] = "valid"
+        client = GitHubGraphQLClient()
+
+        with patch("main.load_env_var", return_value="valid") as load_env_var_mock:
+            client.github_graphql_url
+            client.github_graphql_url
+            client.headers
+            client.headers
+
+        self.assertEqual(load_env_var_mock.call_count, 2)
+
+
+class TestBuildCodeProsMatcher(unittest.TestCase):
+
+    def test_no_match(self):
+        match_code_pros_globs = build_code_pros_matcher([make_code_pros_glob("src/*", {"@pro"})])
+        self.assertEqual(match_code_pros_globs("main.py"), [])
+
+    def test_all_matches_returned(self):
+        code_pro_globs = [
+            make_code_pros_glob("**/*.py", {"@pro"}),
+            make_code_pros_glob("src/*", {"@pro2"}),
+            make_code_pros_glob("src/main.py", {"@pro3"}),
+        ]
+        match_code_pros_globs = build_code_pros_matcher(code_pro_globs)
+
+        self.assertEqual(match_code_pros_globs("src/main.py"), code_pro_globs)
+        self.assertEqual(match_code_pros_globs("src/README.md"), [code_pro_globs[1]])
+
+    def test_prefix_buckets(self):
+        code_pro_globs = [
+            make_code_pros_glob("src/*", {"@pro"}),
+            make_code_pros_glob("**/*.md", {"@pro2"}),
+            make_code_pros_glob("docs/*", {"@pro3"}),
+            make_code_pros_glob("main.py", {"@pro4"}),
+        ]
+        match_code_pros_globs = build_code_pros_matcher(code_pro_globs)
+
+        self.assertEqual(match_code_pros_globs("src/README.md"), code_pro_globs[:2])
+        self.assertEqual(match_code_pros_globs("docs/README.md"), code_pro_globs[1:3])
+        self.assertEqual(match_code_pros_globs("README.md"), [code_pro_globs[1]])
+        self.assertEqual(match_code_pros_globs("main.py"), [code_pro_globs[3]])
+        self.assertEqual(match_code_pros_globs("test/main.py"), [])
+
+    def test_specialized_and_regex_matchers_agree(self):
+        code_pro_globs = [
+            make_code_pros_glob("**/*.py", {"@pro"}),
+            make_code_pros_glob("src/*", {"@pro2"}),
+            make_code_pros_glob("src/main.py", {"@pro3"}),
+        ]
+        match_specialized = build_specialized_matcher(code_pro_globs)
+        match_regex = build_regex_matcher(code_pro_globs)
+
+        for changed_file in ["src/main.py", "src/README.md", "main.py", "docs/README.md"]:
+            self.assertEqual(match_specialized(changed_file), match_regex(changed_file))
+
+    @patch("main.SPECIALIZED_MATCHER_MAX_GLOBS", 1)
+    def test_large_buckets_use_regex_matcher(self):
+        code_pro_globs = [make_code_pros_glob("src/*", {"@pro"}), make_code_pros_glob("src/*.py", {"@pro2"})]
+
+        with patch("main.build_regex_matcher", wraps=build_regex_matcher) as build_regex_matcher_mock:
+            match_code_pros_globs = build_code_pros_matcher(code_pro_globs)
+
+        build_regex_matcher_mock.assert_called_once_with(code_pro_globs)
+        self.assertEqual(match_code_pros_globs("src/main.py"), code_pro_globs)
+
+
+class TestGetPullRequestData(unittest.TestCase):
+
+    @patch(
+        "main.github_graphql_client.make_request",
+        return_value={"data": {"node": {"commits": {"totalCount": 1}, "comments": {"nodes": []}}}})
+    def test_single_request(self, github_graphql):
+        pull_request_data = get_pull_request_data(123)
+
+        github_graphql.assert_called_once_with(GRAPHQL_GET_PR_BOOTSTRAP, {"nodeId": 123, "includeComments": True})
+        self.assertEqual(pull_request_data["commits"]["totalCount"], 1)
+        self.assertEqual(pull_request_data["comments"]["nodes"], [])
 
     @patch(
         "main.github_graphql_client.make_request",
-        return_value={"data": {"node": {"comments": {"nodes": [{"id": 1, "body": PR_COMMENT_TITLE}]}}}})
+        return_value={"data": {"node": {"commits": {"totalCount": 1}}}})
+    def test_skip_comments(self, github_graphql):
+        _ = get_pull_request_data(123, include_comments=False)
+        github_graphql.assert_called_once_with(GRAPHQL_GET_PR_BOOTSTRAP, {"nodeId": 123, "includeComments": False})
+
+
+class TestGetCodePros(unittest.TestCase):
+
+    def test_no_pros(self):
+        code_pro_globs = [make_code_pros_glob("src/*", {"@pro"})]
+        self.assertEqual(get_code_pros(["main.py"], code_pro_globs), set())
+
+    def test_pros_collected(self):
+        code_pro_globs = [
+            make_code_pros_glob("*.py", {"@pro"}),
+            make_code_pros_glob("src/*", {"@pro2"}),
+            make_code_pros_glob("docs/*", {"@pro3"}),
+        ]
+        self.assertEqual(get_code_pros(["main.py", "src/README.md"], code_pro_globs), {"@pro", "@pro2"})
+
+    def test_stop_when_all_pros_found(self):
+        code_pro_globs = [make_code_pros_glob("*", {"@pro"})]
+        changed_files = iter(["main.py", "test_main.py"])
+
+        self.assertEqual(get_code_pros(changed_files, code_pro_globs), {"@pro"})
+        self.assertEqual(list(changed_files), ["test_main.py"])
+
+    def test_covered_rules_skipped(self):
+        code_pro_globs = [
+            make_code_pros_glob("*.py", {"@pro"}),
+            make_code_pros_glob("main.py", {"@pro"}),
+            make_code_pros_glob("docs/*", {"@pro2"}),
+        ]
+
+        with patch("main.build_code_pros_matcher", wraps=build_code_pros_matcher) as build_code_pros_matcher_mock:
+            with patch("builtins.print") as print_mock:
+                pros = get_code_pros(["test_main.py", "main.py"], code_pro_globs)
+
+        self.assertEqual(pros, {"@pro"})
+        build_code_pros_matcher_mock.assert_called_once_with(code_pro_globs)
+        print_mock.assert_called_once_with("Rule *.py matches test_main.py")
+
+
+class TestFindPRComment(unittest.TestCase):
+
+    def test_labeled_comment_id(self):
+        labels = [{"name": "bug"}, {"name": f"{PR_COMMENT_LABEL_PREFIX}IC_abc"}]
+        self.assertEqual(get_labeled_comment_id(labels), "IC_abc")
+
+    def test_no_labeled_comment_id(self):
+        self.assertIsNone(get_labeled_comment_id([{"name": "bug"}]))
+
+    def test_stale_labeled_comment_id(self):
+        labels = [{"name": f"{PR_COMMENT_LABEL_PREFIX}IC_old"}, {"name": f"{PR_COMMENT_LABEL_PREFIX}IC_new"}]
+        self.assertIsNone(get_labeled_comment_id(labels))
+
+    def test_find_comment_id(self):
+        comments = [{"id": 1, "body": "lgtm"}, {"id": 2, "body": PR_COMMENT_TITLE}]
+        self.assertEqual(find_pr_comment_id(comments), 2)
+
+    def test_comment_id_not_found(self):
+        self.assertIsNone(find_pr_comment_id([{"id": 1, "body": "lgtm"}]))
+
+
+class TestLabelPRComment(unittest.TestCase):
+
+    @patch("main.github_graphql_client.make_rest_request")
+    def test_add_label(self, github_rest):
+        label_pr_comment("a/b", 1, "IC_new")
+        github_rest.assert_called_once_with(
+            "POST", "/repos/a/b/issues/1/labels", {"labels": [f"{PR_COMMENT_LABEL_PREFIX}IC_new"]})
+
+    @patch("main.github_graphql_client.make_rest_request")
+    def test_replace_stale_label(self, github_rest):
+        label_pr_comment("a/b", 1, "IC_new", stale_comment_id="IC_old")
+        self.assertEqual(github_rest.call_args_list[0][0][0], "POST")
+        self.assertEqual(github_rest.call_args_list[1][0], ("DELETE", "/repos/a/b/labels/codenotify%3AIC_old"))
+
+    @patch("main.github_graphql_client.make_rest_request", side_effect=[
+        None, GitHubAPIError("not found", status_code=404)])
+    def test_stale_label_already_deleted(self, github_rest):
+        label_pr_comment("a/b", 1, "IC_new", stale_comment_id="IC_old")
+        self.assertEqual(github_rest.call_count, 2)
+
+    @patch("main.github_graphql_client.make_rest_request", side_effect=GitHubAPIError("forbidden", status_code=403))
+    def test_label_failure_ignored(self, github_rest):
+        label_pr_comment("a/b", 1, "IC_new", stale_comment_id="IC_old")
+
+        # the stale label is still deleted, even though the new one couldn't be added
+        self.assertEqual(github_rest.call_args_list[1][0][0], "DELETE")
+
+
+class TestCommentOnPR(unittest.TestCase):
+
+    NEW_COMMENT_RESPONSE = {"data": {"addComment": {"commentEdge": {"node": {"id": "IC_new"}}}}}
+
+    @patch("main.github_graphql_client.make_request")
     def test_update_comment(self, github_graphql):
-        comment_on_pr(123, "@pro")
+        comment_id = comment_on_pr(123, "@pro", "IC_old")
+
         self.assertEqual(github_graphql.call_args[0][0], GRAPHQL_UPDATE_PR_COMMENT)
+        self.assertEqual(comment_id, "IC_old")
 
-    @patch("main.github_graphql_client.make_request", return_value={"data": {"node": {"comments": {"nodes": []}}}})
+    @patch("main.github_graphql_client.make_request", return_value=NEW_COMMENT_RESPONSE)
     def test_add_new_comment(self, github_graphql):
-        comment_on_pr(123, "@pro")
+        comment_id = comment_on_pr(123, "@pro")
+
         self.assertEqual(github_graphql.call_args[0][0], GRAPHQL_ADD_PR_COMMENT)
+        self.assertEqual(comment_id, "IC_new")
+
+    @patch("main.github_graphql_client.make_request", side_effect=[
+        GitHubAPIError("gone", errors=[{"type": "NOT_FOUND", "message": "Could not resolve to a node"}]),
+        NEW_COMMENT_RESPONSE])
+    def test_deleted_comment_replaced(self, github_graphql):
+        comment_id = comment_on_pr(123, "@pro", "IC_old")
+
+        self.assertEqual(github_graphql.call_args[0][0], GRAPHQL_ADD_PR_COMMENT)
+        self.assertEqual(comment_id, "IC_new")
+
+    @patch("main.github_graphql_client.make_request", side_effect=GitHubAPIError("unavailable"))
+    def test_failed_update_not_duplicated(self, github_graphql):
+        with self.assertRaises(GitHubAPIError):
+            _ = comment_on_pr(123, "@pro", "IC_old")
+
+        github_graphql.assert_called_once()
+        self.assertEqual(github_graphql.call_args[0][0], GRAPHQL_UPDATE_PR_COMMENT)
 
 
 class TestGetGitHubEventData(unittest.TestCase):
@@ -228,6 +651,32 @@ class TestGetGitHubEventData(unittest.TestCase):
             event_data = get_github_event_data("event.json")
             self.assertFalse(event_data["pull_request"]["draft"])
 
+    def test_unused_event_data_dropped(self):
+        event = {
+            "action": "synchronize",
+            "pull_request": {
+                "base": {"sha": "40b282f", "repo": {"full_name": "routablehq/codenotify-python"}},
+                "body": "a long description",
+                "draft": False,
+                "head": {"sha": "8ef970e", "repo": {"full_name": "someone/codenotify-python"}},
+                "labels": [{"name": "bug", "color": "d73a4a"}],
+                "node_id": "abc",
+                "user": {"login": "pro", "avatar_url": "https://example.com/pro.png"}},
+            "repository": {"full_name": "routablehq/codenotify-python", "description": "notify code pros"},
+        }
+        with patch("builtins.open", new_callable=mock_open, read_data=json.dumps(event).encode()):
+            event_data = get_github_event_data("event.json")
+
+        self.assertEqual(event_data, {
+            "pull_request": {
+                "base": {"sha": "40b282f"},
+                "draft": False,
+                "head": {"sha": "8ef970e"},
+                "labels": [{"name": "bug"}],
+                "node_id": "abc",
+                "user": {"login": "pro"}},
+            "repository": {"full_name": "routablehq/codenotify-python"}})
+
 
 class TestMain(unittest.TestCase):
 
@@ -237,12 +686,22 @@ class TestMain(unittest.TestCase):
                 "draft": False,
                 "head": {"sha": "8ef970e3b8682ef36bf0bf1586999bafca42231e"},
                 "node_id": "MDExOlB1bGxSZXF1ZXN0NjU3NTE0MzY1",
-                "user": {"login": "@pro"}}}
+                "number": 1,
+                "user": {"login": "@pro"}},
+            "repository": {"full_name": "routablehq/codenotify-python"}}
+
+    PULL_REQUEST_DATA = {
+            "commits": {"totalCount": 3},
+            "comments": {"nodes": [{"id": 1, "body": PR_COMMENT_TITLE}]}}
 
     def setUp(self):
         os.environ[GITHUB_WORKSPACE_ENV_VAR] = "full_flow"
         os.environ[GITHUB_EVENT_PATH_ENV_VAR] = "full_flow"
 
+        get_checkout_commit_patcher = patch("main.get_checkout_commit", return_value=None)
+        self.get_checkout_commit_mock = get_checkout_commit_patcher.start()
+        self.addCleanup(get_checkout_commit_patcher.stop)
+
     @patch("main.get_code_pros_globs")
     def test_ignore_draft_pr(self, get_code_pros_globs):
         event_data = deepcopy(self.GITHUB_EVENT_DATA)
@@ -253,6 +712,33 @@ class TestMain(unittest.TestCase):
 
         get_code_pros_globs.assert_not_called()
 
+    @patch("main.get_changed_files")
+    @patch("main.get_code_pros_globs", return_value=[make_code_pros_glob("docs/*", {"@pro"})])
+    @patch("main.get_github_event_data", return_value=GITHUB_EVENT_DATA)
+    def test_prune_on_head_checkout(self,
+                                    get_github_event_data_mock,
+                                    get_code_pros_globs_mock,
+                                    get_changed_files_mock):
+        self.get_checkout_commit_mock.return_value = self.GITHUB_EVENT_DATA["pull_request"]["head"]["sha"]
+        main()
+
+        self.get_checkout_commit_mock.assert_called_once_with("full_flow")
+        get_changed_files_mock.assert_not_called()
+
+    @patch("main.get_pull_request_data", return_value=PULL_REQUEST_DATA)
+    @patch("main.get_changed_files", return_value=[])
+    @patch("main.get_code_pros_globs", return_value=[make_code_pros_glob("docs/*", {"@pro"})])
+    @patch("main.get_github_event_data", return_value=GITHUB_EVENT_DATA)
+    def test_no_prune_on_other_checkout(self,
+                                        get_github_event_data_mock,
+                                        get_code_pros_globs_mock,
+                                        get_changed_files_mock,
+                                        get_pull_request_data_mock):
+        self.get_checkout_commit_mock.return_value = self.GITHUB_EVENT_DATA["pull_request"]["base"]["sha"]
+        main()
+
+        get_changed_files_mock.assert_called_once()
+
     @patch("main.get_changed_files")
     @patch("main.get_github_event_data", return_value=GITHUB_EVENT_DATA)
     def test_no_code_pro_globs(self, get_github_event_data_mock, get_changed_files_mock):
@@ -261,14 +747,58 @@ class TestMain(unittest.TestCase):
 
         get_changed_files_mock.assert_not_called()
 
+    @patch("main.label_pr_comment")
     @patch("main.get_changed_files", return_value=["main.py"])
-    @patch("main.get_code_pros_globs", return_value=[CodeProsGlob("*", {"@pro"})])
+    @patch("main.get_pull_request_data", return_value=PULL_REQUEST_DATA)
+    @patch("main.get_code_pros_globs", return_value=[make_code_pros_glob("*", {"@pro"})])
     @patch("main.get_github_event_data", return_value=GITHUB_EVENT_DATA)
-    def test_full_flow(self, get_github_event_data_mock, get_code_pros_globs_mock, get_changed_files_mock):
-        with patch("main.comment_on_pr") as comment_on_pr_mock:
+    def test_full_flow(self,
+                       get_github_event_data_mock,
+                       get_code_pros_globs_mock,
+                       get_pull_request_data_mock,
+                       get_changed_files_mock,
+                       label_pr_comment_mock):
+        with patch("main.comment_on_pr", return_value=1) as comment_on_pr_mock:
             main()
 
-        comment_on_pr_mock.assert_called_with(self.GITHUB_EVENT_DATA["pull_request"]["node_id"], {"@pro"})
+        get_pull_request_data_mock.assert_called_once_with(
+            self.GITHUB_EVENT_DATA["pull_request"]["node_id"], include_comments=True)
+        github_dir, base_ref, head_ref, get_commit_count = get_changed_files_mock.call_args[0]
+        self.assertEqual(github_dir, "full_flow")
+        self.assertEqual(base_ref, self.GITHUB_EVENT_DATA["pull_request"]["base"]["sha"])
+        self.assertEqual(head_ref, self.GITHUB_EVENT_DATA["pull_request"]["head"]["sha"])
+        self.assertEqual(get_commit_count(), 3)
+
+        comment_on_pr_mock.assert_called_with(self.GITHUB_EVENT_DATA["pull_request"]["node_id"], {"@pro"}, 1)
+        label_pr_comment_mock.assert_called_with("routablehq/codenotify-python", 1, 1, stale_comment_id=None)
+        # no rule names a directory, so there was nothing to prune and no reason to ask git for the checkout
+        self.get_checkout_commit_mock.assert_not_called()
+
+    @patch("main.label_pr_comment")
+    @patch("main.get_changed_files", return_value=["main.py"])
+    @patch("main.get_pull_request_data", return_value={"commits": {"totalCount": 3}})
+    @patch("main.get_code_pros_globs", return_value=[make_code_pros_glob("*", {"@pro"})])
+    def test_labeled_comment(self,
+                             get_code_pros_globs_mock,
+                             get_pull_request_data_mock,
+                             get_changed_files_mock,
+                             label_pr_comment_mock):
+        event_data = deepcopy(self.GITHUB_EVENT_DATA)
+        event_data["pull_request"]["labels"] = [{"name": f"{PR_COMMENT_LABEL_PREFIX}IC_abc"}]
+
+        with patch("main.get_github_event_data", return_value=event_data):
+            with patch("main.comment_on_pr", return_value="IC_abc") as comment_on_pr_mock:
+                main()
+
+        get_pull_request_data_mock.assert_not_called()
+        comment_on_pr_mock.assert_called_with(self.GITHUB_EVENT_DATA["pull_request"]["node_id"], {"@pro"}, "IC_abc")
+        label_pr_comment_mock.assert_not_called()
+
+        # the commit count is only queried if the clone has to be deepened, and without the comments
+        get_commit_count = get_changed_files_mock.call_args[0][3]
+        self.assertEqual(get_commit_count(), 3)
+        get_pull_request_data_mock.assert_called_once_with(
+            self.GITHUB_EVENT_DATA["pull_request"]["node_id"], include_comments=False)
 
 
 if __name__ == "__main__":